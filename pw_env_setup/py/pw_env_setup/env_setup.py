@@ -222,6 +222,7 @@ class EnvSetup(object):
         self._virtualenv_constraints = []
         self._virtualenv_gn_targets = []
         self._virtualenv_gn_args = []
+        self._virtualenv_pip_install_cache_dir = None
         self._virtualenv_pip_install_disable_cache = False
         self._virtualenv_pip_install_find_links = []
         self._virtualenv_pip_install_offline = False
@@ -394,6 +395,9 @@ class EnvSetup(object):
         ):
             self._virtualenv_pip_install_find_links.append(pip_cache_dir)
 
+        self._virtualenv_pip_install_cache_dir = virtualenv.pop(
+            'pip_install_cache_dir', None
+        )
         self._virtualenv_pip_install_disable_cache = virtualenv.pop(
             'pip_install_disable_cache', False
         )
@@ -773,6 +777,7 @@ Then use `set +x` to go back to normal.
             pip_install_require_hashes=(
                 self._virtualenv_pip_install_require_hashes
             ),
+            pip_install_cache_dir=self._virtualenv_pip_install_cache_dir,
             pip_install_disable_cache=(
                 self._virtualenv_pip_install_disable_cache
             ),
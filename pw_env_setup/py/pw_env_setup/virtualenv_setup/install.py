@@ -15,9 +15,12 @@
 
 from __future__ import print_function
 
+import collections
 import contextlib
 import datetime
-import glob
+import functools
+import hashlib
+import itertools
 import os
 import platform
 import re
@@ -25,12 +28,24 @@ import shutil
 import subprocess
 import sys
 import stat
-import tempfile
+import time
 
 # Grabbing datetime string once so it will always be the same for all GnTarget
 # objects.
 _DATETIME_STRING = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
 
+# Seconds between pip/setuptools/wheel upgrade checks in an existing venv.
+_PIP_UPGRADE_MAX_AGE = 24 * 60 * 60
+
+# Matches requirement file lines that include another requirement or
+# constraint file, e.g. "-c ./python_base_requirements.txt".
+_PIP_INCLUDE_RE = re.compile(
+    r'(?:--requirement|--constraint|-r|-c)\s*=?\s*(\S+)'
+)
+
+# Number of trailing output lines _check_call() reports when a command fails.
+_CHECK_CALL_TAIL_LINES = 1000
+
 
 def _is_windows() -> bool:
     return platform.system().lower() == 'windows'
@@ -39,9 +54,18 @@ def _is_windows() -> bool:
 class GnTarget(object):  # pylint: disable=useless-object-inheritance
     def __init__(self, val):
         self.directory, self.target = val.split('#', 1)
-        self.name = '-'.join(
-            (re.sub(r'\W+', '_', self.target).strip('_'), _DATETIME_STRING)
-        )
+        self.name = _log_name(self.target)
+
+
+def _log_name(target, extra_targets=0):
+    """Returns a log file name fragment for target and extra_targets others.
+
+    Only the first target of a batch is spelled out, so the fragment stays
+    well within file name length limits however many targets are batched.
+    """
+    if extra_targets:
+        target = '{} plus {} more'.format(target, extra_targets)
+    return '-'.join((re.sub(r'\W+', '_', target).strip('_'), _DATETIME_STRING))
 
 
 def git_stdout(*args, **kwargs):
@@ -51,6 +75,12 @@ def git_stdout(*args, **kwargs):
 
 def git_repo_root(path='./'):
     """Find git repository root."""
+    # Resolve relative paths here so the cache isn't fooled by chdir().
+    return _git_repo_root(os.path.abspath(path))
+
+
+@functools.lru_cache(maxsize=None)
+def _git_repo_root(path):
     try:
         return git_stdout('-C', path, 'rev-parse', '--show-toplevel')
     except subprocess.CalledProcessError:
@@ -82,18 +112,25 @@ def _required_packages(requirements):
 
 
 def _check_call(args, **kwargs):
-    stdout = kwargs.get('stdout', sys.stdout)
-
-    with tempfile.TemporaryFile(mode='w+') as temp:
-        try:
-            kwargs['stdout'] = temp
-            kwargs['stderr'] = subprocess.STDOUT
-            print(args, kwargs, file=temp)
-            subprocess.check_call(args, **kwargs)
-        except subprocess.CalledProcessError:
-            temp.seek(0)
-            stdout.write(temp.read())
-            raise
+    stdout = kwargs.pop('stdout', sys.stdout)
+
+    # Keep only the tail of the output in memory and surface it if the
+    # command fails. pip in particular can be extremely verbose.
+    with subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        errors='replace',
+        **kwargs,
+    ) as proc:
+        tail = collections.deque(proc.stdout, maxlen=_CHECK_CALL_TAIL_LINES)
+        returncode = proc.wait()
+
+    if returncode:
+        print(args, kwargs, file=stdout)
+        stdout.writelines(tail)
+        raise subprocess.CalledProcessError(returncode, args, ''.join(tail))
 
 
 def _find_files_by_name(roots, name, allow_nesting=False):
@@ -113,6 +150,103 @@ def _find_files_by_name(roots, name, allow_nesting=False):
     return matches
 
 
+def _pip_inputs_hash(version, pip_install_args, requirements, constraints):
+    """Returns a digest of everything that affects the pip install steps.
+
+    Files pulled in by -r or -c lines in requirement and constraint files are
+    hashed too. Returns None if any input can't be read locally (e.g. a URL),
+    since changes to it can't be detected.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(repr((tuple(version), list(pip_install_args))).encode())
+
+    # Entries are (path as written, directory it is relative to). URLs are
+    # detected before normalizing, which would mangle their "//".
+    pending = [(path, '') for path in requirements or ()]
+    pending.extend((path, '') for path in constraints or ())
+    seen = set()
+    while pending:
+        raw_path, base_dir = pending.pop(0)
+        if '://' in raw_path:
+            return None
+        path = os.path.normpath(os.path.join(base_dir, raw_path))
+        if path in seen:
+            continue
+        seen.add(path)
+
+        try:
+            with open(path, 'rb') as ins:
+                contents = ins.read()
+        except OSError:
+            return None
+
+        hasher.update(path.encode())
+        hasher.update(hashlib.sha256(contents).digest())
+
+        # pip resolves nested files relative to the file that includes them.
+        for line in contents.decode(errors='replace').splitlines():
+            match = _PIP_INCLUDE_RE.match(line.strip())
+            if match:
+                pending.append(
+                    (os.path.expandvars(match.group(1)), os.path.dirname(path))
+                )
+
+    return hasher.hexdigest()
+
+
+def _read_text(path):
+    """Returns the stripped contents of path, or None if it can't be read."""
+    try:
+        with open(path, 'r') as ins:
+            return ins.read().strip()
+    except OSError:
+        return None
+
+
+def _is_recent(path, max_age=_PIP_UPGRADE_MAX_AGE):
+    """Returns True if path exists and was modified within max_age seconds."""
+    try:
+        return time.time() - os.path.getmtime(path) < max_age
+    except OSError:
+        return False
+
+
+def _write_text_atomic(path, contents):
+    """Writes contents to path so readers never see a partial file."""
+    temp_path = '{}.tmp'.format(path)
+    with open(temp_path, 'w') as outs:
+        outs.write(contents)
+    os.replace(temp_path, path)
+
+
+def _iter_egg_links(venv_path):
+    """Yields paths of .egg-link files in the venv's site-packages dirs."""
+    try:
+        with os.scandir(os.path.join(venv_path, 'lib')) as lib_entries:
+            python_dirs = [
+                entry.path
+                for entry in lib_entries
+                if entry.name.startswith('python')
+            ]
+    except OSError:
+        return
+
+    for python_dir in python_dirs:
+        site_packages = os.path.join(python_dir, 'site-packages')
+        try:
+            with os.scandir(site_packages) as entries:
+                # Collect before yielding so callers may unlink the results
+                # without mutating the directory mid-scan.
+                egg_links = [
+                    entry.path
+                    for entry in entries
+                    if entry.name.endswith('.egg-link')
+                ]
+        except OSError:
+            continue
+        yield from egg_links
+
+
 def _check_venv(python, version, venv_path, pyvenv_cfg):
     if _is_windows():
         return
@@ -195,6 +329,7 @@ def install(  # pylint: disable=too-many-arguments,too-many-locals,too-many-stat
     full_envsetup=True,
     requirements=None,
     constraints=None,
+    pip_install_cache_dir=None,
     pip_install_disable_cache=None,
     pip_install_find_links=None,
     pip_install_offline=None,
@@ -293,9 +428,7 @@ def install(  # pylint: disable=too-many-arguments,too-many-locals,too-many-stat
     # installed location". This gets around that. The egg-link files
     # all come from 'pw'-prefixed packages we installed with --editable.
     # Source: https://stackoverflow.com/a/48972085
-    for egg_link in glob.glob(
-        os.path.join(venv_path, 'lib/python*/site-packages/*.egg-link')
-    ):
+    for egg_link in _iter_egg_links(venv_path):
         os.unlink(egg_link)
 
     pip_install_args = []
@@ -310,6 +443,10 @@ def install(  # pylint: disable=too-many-arguments,too-many-locals,too-many-stat
         pip_install_args.append('--no-index')
     if pip_install_disable_cache:
         pip_install_args.append('--no-cache-dir')
+    elif pip_install_cache_dir:
+        pip_install_args.append('--cache-dir')
+        with env():
+            pip_install_args.append(os.path.expandvars(pip_install_cache_dir))
 
     def pip_install(*args):
         args = list(_flatten(args))
@@ -333,46 +470,80 @@ def install(  # pylint: disable=too-many-arguments,too-many-locals,too-many-stat
             '--constraint={}'.format(constraint) for constraint in constraints
         )
 
-    pip_install(
-        '--log',
-        os.path.join(venv_path, 'pip-upgrade.log'),
-        '--upgrade',
-        'pip',
-        'setuptools',
-        'toml',  # Needed for pyproject.toml package installs.
-        # Include wheel so pip installs can be done without build
-        # isolation.
-        'wheel',
-        'pip-tools',
-        constraint_args,
-    )
-
     # TODO(tonymd): Remove this when projects have defined requirements.
     if (not requirements) and constraints:
         requirements = constraints
 
-    if requirements:
-        requirement_args = []
-        # Note: --no-build-isolation should be avoided for installing 3rd party
-        # Python packages that use C/C++ extension modules.
-        # https://setuptools.pypa.io/en/latest/userguide/ext_modules.html
-        requirement_args.extend(
-            '--requirement={}'.format(req) for req in requirements
-        )
-        combined_requirement_args = requirement_args + constraint_args
-        pip_install(
-            '--log',
-            os.path.join(venv_path, 'pip-requirements.log'),
-            combined_requirement_args,
-        )
+    # Skip the pip calls entirely if nothing that feeds into them changed since
+    # the last successful install into this venv.
+    pip_hash_path = os.path.join(venv_path, 'pip-requirements.sha256')
+    pip_hash = _pip_inputs_hash(
+        version, pip_install_args, requirements, constraints
+    )
+    pip_inputs_changed = (
+        pip_hash is None or _read_text(pip_hash_path) != pip_hash
+    )
+    if full_envsetup or pip_inputs_changed:
+        # Upgrading pip and friends rarely changes anything, so only do it
+        # when the inputs changed or the last upgrade is more than a day old.
+        # The stamp records the digest the upgrade ran against, so a change to
+        # any (possibly nested) constraint file triggers it right away.
+        pip_upgrade_stamp = os.path.join(venv_path, 'pip-upgrade.stamp')
+        if (
+            pip_hash is None
+            or _read_text(pip_upgrade_stamp) != pip_hash
+            or not _is_recent(pip_upgrade_stamp)
+        ):
+            pip_install(
+                '--log',
+                os.path.join(venv_path, 'pip-upgrade.log'),
+                '--upgrade',
+                'pip',
+                'setuptools',
+                'toml',  # Needed for pyproject.toml package installs.
+                # Include wheel so pip installs can be done without build
+                # isolation.
+                'wheel',
+                'pip-tools',
+                constraint_args,
+            )
+            if pip_hash is not None:
+                _write_text_atomic(pip_upgrade_stamp, pip_hash)
+
+        if requirements:
+            requirement_args = []
+            # Note: --no-build-isolation should be avoided for installing 3rd
+            # party Python packages that use C/C++ extension modules.
+            # https://setuptools.pypa.io/en/latest/userguide/ext_modules.html
+            requirement_args.extend(
+                '--requirement={}'.format(req) for req in requirements
+            )
+            combined_requirement_args = requirement_args + constraint_args
+            pip_install(
+                '--log',
+                os.path.join(venv_path, 'pip-requirements.log'),
+                combined_requirement_args,
+            )
+
+        if pip_hash is not None:
+            _write_text_atomic(pip_hash_path, pip_hash)
+
+    def install_packages(directory, gn_targets):
+        # All targets share one build directory, so instead of building them
+        # concurrently, generate once and hand every target to a single ninja
+        # invocation, which schedules their actions in parallel.
+        targets = [gn_target.target for gn_target in gn_targets]
+        if len(gn_targets) == 1:
+            log_name = gn_targets[0].name
+        else:
+            log_name = _log_name(targets[0], len(targets) - 1)
 
-    def install_packages(gn_target):
         if gn_out_dir is None:
             build_dir = os.path.join(venv_path, 'gn')
         else:
             build_dir = gn_out_dir
 
-        env_log = 'env-{}.log'.format(gn_target.name)
+        env_log = 'env-{}.log'.format(log_name)
         env_log_path = os.path.join(venv_path, env_log)
         with open(env_log_path, 'w') as outs:
             for key, value in sorted(os.environ.items()):
@@ -385,7 +556,7 @@ def install(  # pylint: disable=too-many-arguments,too-many-locals,too-many-stat
                 else:
                     print(key, '=', value, file=outs)
 
-        gn_log = 'gn-gen-{}.log'.format(gn_target.name)
+        gn_log = 'gn-gen-{}.log'.format(log_name)
         gn_log_path = os.path.join(venv_path, gn_log)
         try:
             with open(gn_log_path, 'w') as outs:
@@ -401,7 +572,7 @@ def install(  # pylint: disable=too-many-arguments,too-many-locals,too-many-stat
                 print(gn_cmd, file=outs)
                 subprocess.check_call(
                     gn_cmd,
-                    cwd=os.path.join(project_root, gn_target.directory),
+                    cwd=os.path.join(project_root, directory),
                     stdout=outs,
                     stderr=outs,
                 )
@@ -411,12 +582,12 @@ def install(  # pylint: disable=too-many-arguments,too-many-locals,too-many-stat
                     err.returncode, err.cmd, ins.read()
                 )
 
-        ninja_log = 'ninja-{}.log'.format(gn_target.name)
+        ninja_log = 'ninja-{}.log'.format(log_name)
         ninja_log_path = os.path.join(venv_path, ninja_log)
         try:
             with open(ninja_log_path, 'w') as outs:
                 ninja_cmd = ['ninja', '-C', build_dir, '-v']
-                ninja_cmd.append(gn_target.target)
+                ninja_cmd.extend(targets)
                 print(ninja_cmd, file=outs)
                 subprocess.check_call(ninja_cmd, stdout=outs, stderr=outs)
         except subprocess.CalledProcessError as err:
@@ -425,21 +596,30 @@ def install(  # pylint: disable=too-many-arguments,too-many-locals,too-many-stat
                     err.returncode, err.cmd, ins.read()
                 )
 
-        with open(os.path.join(venv_path, 'pip-list.log'), 'w') as outs:
-            subprocess.check_call(
-                [
-                    venv_python,
-                    '-m',
-                    'pip',
-                    '--disable-pip-version-check',
-                    'list',
-                ],
-                stdout=outs,
-            )
-
     if gn_targets:
         with env():
-            for gn_target in gn_targets:
-                install_packages(gn_target)
+            # Consecutive targets in the same GN root are built together by
+            # one ninja invocation, which may build them in any order. Only
+            # targets in different roots are guaranteed to run in the order
+            # given.
+            for directory, group in itertools.groupby(
+                gn_targets, key=lambda gn_target: gn_target.directory
+            ):
+                install_packages(directory, list(group))
+
+            # Every target writes into the same venv, so only the final
+            # package list is interesting. Record it once instead of paying
+            # for a pip startup after each target.
+            with open(os.path.join(venv_path, 'pip-list.log'), 'w') as outs:
+                subprocess.check_call(
+                    [
+                        venv_python,
+                        '-m',
+                        'pip',
+                        '--disable-pip-version-check',
+                        'list',
+                    ],
+                    stdout=outs,
+                )
 
     return True
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Copyright 2026 The Pigweed Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Tests for the virtualenv_setup install module."""
+
+from pathlib import Path
+import tempfile
+import unittest
+from unittest import mock
+
+# The package re-exports install(), which shadows the install module itself.
+from pw_env_setup.virtualenv_setup.install import (  # type: ignore
+    _pip_inputs_hash,  # pylint: disable=protected-access
+)
+
+_VERSION = (3, 11, 7)
+
+
+class PipInputsHashTest(unittest.TestCase):
+    """Tests for install._pip_inputs_hash."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.temp_path = Path(self.temp_dir.name)
+        (self.temp_path / 'nested').mkdir()
+        self.base = self.temp_path / 'nested' / 'python_base_requirements.txt'
+        self.base.write_text('pip==23.2.1\n')
+        self.constraints = self.temp_path / 'constraint.list'
+        self.constraints.write_text(
+            '-c ./nested/python_base_requirements.txt\n'
+        )
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _hash(self):
+        return _pip_inputs_hash(_VERSION, [], None, [str(self.constraints)])
+
+    def test_unchanged_inputs_match(self):
+        self.assertEqual(self._hash(), self._hash())
+
+    def test_nested_constraint_change_changes_hash(self):
+        before = self._hash()
+        self.base.write_text('pip==23.3\n')
+        self.assertNotEqual(before, self._hash())
+
+    def test_doubly_nested_requirement_change_changes_hash(self):
+        extra = self.temp_path / 'nested' / 'extra.txt'
+        extra.write_text('six==1.16.0\n')
+        self.base.write_text('pip==23.2.1\n--requirement=extra.txt\n')
+        before = self._hash()
+        extra.write_text('six==1.17.0\n')
+        self.assertNotEqual(before, self._hash())
+
+    def test_include_cycle_terminates(self):
+        self.base.write_text('-c ../constraint.list\n')
+        self.assertIsNotNone(self._hash())
+
+    def test_missing_include_disables_hash(self):
+        self.constraints.write_text('-c ./does_not_exist.txt\n')
+        self.assertIsNone(self._hash())
+
+    @mock.patch('builtins.open', wraps=open)
+    def test_url_include_disables_hash(self, open_mock):
+        self.constraints.write_text('-r https://example.com/reqs.txt\n')
+        self.assertIsNone(self._hash())
+        # URLs must be rejected as such, not by failing to open a mangled path.
+        for call in open_mock.call_args_list:
+            self.assertNotIn('example.com', str(call.args[0]))
+
+    @mock.patch('builtins.open', wraps=open)
+    def test_url_input_disables_hash(self, open_mock):
+        self.assertIsNone(
+            _pip_inputs_hash(_VERSION, [], ['https://example.com/reqs.txt'], [])
+        )
+        open_mock.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -28,7 +28,15 @@ import random
 import socket
 import sys
 import time
-from typing import Awaitable, Callable, Iterable, List, NamedTuple, Optional
+from typing import (
+    Awaitable,
+    Callable,
+    Generator,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+)
 
 from google.protobuf import text_format
 
@@ -68,6 +76,22 @@ class Event(NamedTuple):
     chunk: Chunk
 
 
+# Handler a Filter passes its output to. It may be a coroutine function or a
+# plain function; plain functions are called without allocating a coroutine
+# for every piece of data.
+SendData = Callable[[bytes], Optional[Awaitable[None]]]
+
+
+class _Completed:
+    """An awaitable that is already done, used for synchronous handlers."""
+
+    def __await__(self) -> Generator[None, None, None]:
+        yield from ()
+
+
+_COMPLETED = _Completed()
+
+
 class Filter(abc.ABC):
     """An abstract interface for manipulating a stream of data.
 
@@ -79,8 +103,13 @@ class Filter(abc.ABC):
     and call ``self.send_data()`` when it has data to send.
     """
 
-    def __init__(self, send_data: Callable[[bytes], Awaitable[None]]):
-        self.send_data = send_data
+    def __init__(self, send_data: SendData):
+        self._send_data = send_data
+
+    def send_data(self, data: bytes) -> Awaitable[None]:
+        """Passes data to the next stage of the filter stack."""
+        result = self._send_data(data)
+        return _COMPLETED if result is None else result
 
     @abc.abstractmethod
     async def process(self, data: bytes) -> None:
@@ -102,7 +131,7 @@ class HdlcPacketizer(Filter):
     downstream filters see whole frames.
     """
 
-    def __init__(self, send_data: Callable[[bytes], Awaitable[None]]):
+    def __init__(self, send_data: SendData):
         super().__init__(send_data)
         self.decoder = decode.FrameDecoder()
 
@@ -120,7 +149,7 @@ class DataDropper(Filter):
 
     def __init__(
         self,
-        send_data: Callable[[bytes], Awaitable[None]],
+        send_data: SendData,
         name: str,
         rate: float,
         seed: Optional[int] = None,
@@ -169,7 +198,7 @@ class KeepDropQueue(Filter):
 
     def __init__(
         self,
-        send_data: Callable[[bytes], Awaitable[None]],
+        send_data: SendData,
         name: str,
         keep_drop_queue: Iterable[int],
         only_consider_transfer_chunks: bool = False,
@@ -214,9 +243,7 @@ class RateLimiter(Filter):
     This filter delays transmission of data by len(data)/rate.
     """
 
-    def __init__(
-        self, send_data: Callable[[bytes], Awaitable[None]], rate: float
-    ):
+    def __init__(self, send_data: SendData, rate: float):
         super().__init__(send_data)
         self._rate = rate
 
@@ -236,7 +263,7 @@ class DataTransposer(Filter):
 
     def __init__(
         self,
-        send_data: Callable[[bytes], Awaitable[None]],
+        send_data: SendData,
         name: str,
         rate: float,
         timeout: float,
@@ -307,7 +334,7 @@ class ServerFailure(Filter):
 
     def __init__(
         self,
-        send_data: Callable[[bytes], Awaitable[None]],
+        send_data: SendData,
         name: str,
         packets_before_failure_list: List[int],
         start_immediately: bool = False,
@@ -362,7 +389,7 @@ class WindowPacketDropper(Filter):
 
     def __init__(
         self,
-        send_data: Callable[[bytes], Awaitable[None]],
+        send_data: SendData,
         name: str,
         window_packet_to_drop: int,
     ):
@@ -422,7 +449,7 @@ class EventFilter(Filter):
 
     def __init__(
         self,
-        send_data: Callable[[bytes], Awaitable[None]],
+        send_data: SendData,
         name: str,
         event_queue: asyncio.Queue,
     ):
@@ -16,9 +16,10 @@
 
 import abc
 import asyncio
+import functools
 from struct import pack
 import time
-from typing import List
+from typing import Iterable, List
 import unittest
 
 from pigweed.pw_rpc.internal import packet_pb2
@@ -30,12 +31,14 @@ import proxy
 
 
 class MockRng(abc.ABC):
-    def __init__(self, results: List[float]):
-        self._results = results
+    """Returns the given results, in order, from successive uniform() calls."""
+
+    def __init__(self, results: Iterable[float]):
+        self._results = iter(results)
 
     def uniform(self, from_val: float, to_val: float) -> float:
         val_range = to_val - from_val
-        val = self._results.pop()
+        val = next(self._results)
         val *= val_range
         val += from_val
         return val
@@ -46,20 +49,19 @@ class ProxyTest(unittest.IsolatedAsyncioTestCase):
         sent_packets: List[bytes] = []
         new_packets_event: asyncio.Event = asyncio.Event()
 
-        # Async helper so DataTransposer can await on it.
-        async def append(list: List[bytes], data: bytes):
-            list.append(data)
+        def append(data: bytes):
+            sent_packets.append(data)
             # Notify that a new packet was "sent".
             new_packets_event.set()
 
         transposer = proxy.DataTransposer(
-            lambda data: append(sent_packets, data),
+            append,
             name="test",
             rate=0.5,
             timeout=100,
             seed=1234567890,
         )
-        transposer._rng = MockRng([0.6, 0.4])
+        transposer._rng = MockRng([0.4, 0.6])
         await transposer.process(b'aaaaaaaaaa')
         await transposer.process(b'bbbbbbbbbb')
 
@@ -68,7 +70,7 @@ class ProxyTest(unittest.IsolatedAsyncioTestCase):
             # Wait for new packets with a generous timeout.
             try:
                 await asyncio.wait_for(new_packets_event.wait(), timeout=60.0)
-            except TimeoutError:
+            except asyncio.TimeoutError:
                 self.fail(
                     f'Timeout waiting for data.  Packets sent: {sent_packets}'
                 )
@@ -81,40 +83,50 @@ class ProxyTest(unittest.IsolatedAsyncioTestCase):
 
     async def test_transposer_timeout(self):
         sent_packets: List[bytes] = []
+        all_packets_sent_event: asyncio.Event = asyncio.Event()
 
-        # Async helper so DataTransposer can await on it.
-        async def append(list: List[bytes], data: bytes):
-            list.append(data)
+        def append(data: bytes):
+            sent_packets.append(data)
+            # Notify once both packets have been "sent".
+            if len(sent_packets) == 2:
+                all_packets_sent_event.set()
 
         transposer = proxy.DataTransposer(
-            lambda data: append(sent_packets, data),
+            append,
             name="test",
             rate=0.5,
             timeout=0.100,
             seed=1234567890,
         )
-        transposer._rng = MockRng([0.4, 0.6])
+        transposer._rng = MockRng([0.6, 0.4])
         await transposer.process(b'aaaaaaaaaa')
 
         # Even though this should be transposed, there is no following data so
         # the transposer should timout and send this in-order.
         await transposer.process(b'bbbbbbbbbb')
 
-        # Give the transposer time to timeout.
-        await asyncio.sleep(0.5)
+        # Wait for the transposer to time out and flush the held packet, with a
+        # generous timeout.
+        try:
+            await asyncio.wait_for(all_packets_sent_event.wait(), timeout=60.0)
+        except asyncio.TimeoutError:
+            self.fail(
+                f'Timeout waiting for data.  Packets sent: {sent_packets}'
+            )
 
         self.assertEqual(sent_packets, [b'aaaaaaaaaa', b'bbbbbbbbbb'])
 
     async def test_server_failure(self):
         sent_packets: List[bytes] = []
 
-        # Async helper so DataTransposer can await on it.
-        async def append(list: List[bytes], data: bytes):
-            list.append(data)
+        # Production handlers (socket writers, nested filters) are coroutine
+        # functions, so exercise that path here.
+        async def append(data: bytes):
+            sent_packets.append(data)
 
         packets_before_failure = [1, 2, 3]
         server_failure = proxy.ServerFailure(
-            lambda data: append(sent_packets, data),
+            append,
             name="test",
             packets_before_failure_list=packets_before_failure.copy(),
             start_immediately=True,
@@ -147,13 +159,9 @@ class ProxyTest(unittest.IsolatedAsyncioTestCase):
     async def test_server_failure_transfer_chunks_only(self):
         sent_packets = []
 
-        # Async helper so DataTransposer can await on it.
-        async def append(list: List[bytes], data: bytes):
-            list.append(data)
-
         packets_before_failure = [2]
         server_failure = proxy.ServerFailure(
-            lambda data: append(sent_packets, data),
+            sent_packets.append,
             name="test",
             packets_before_failure_list=packets_before_failure.copy(),
             start_immediately=True,
@@ -198,12 +206,13 @@ class ProxyTest(unittest.IsolatedAsyncioTestCase):
     async def test_keep_drop_queue_loop(self):
         sent_packets: List[bytes] = []
 
-        # Async helper so DataTransposer can await on it.
-        async def append(list: List[bytes], data: bytes):
-            list.append(data)
+        # Production handlers (socket writers, nested filters) are coroutine
+        # functions, so exercise that path here.
+        async def append(data: bytes):
+            sent_packets.append(data)
 
         keep_drop_queue = proxy.KeepDropQueue(
-            lambda data: append(sent_packets, data),
+            append,
             name="test",
             keep_drop_queue=[2, 1, 3],
         )
@@ -235,12 +244,8 @@ class ProxyTest(unittest.IsolatedAsyncioTestCase):
     async def test_keep_drop_queue(self):
         sent_packets: List[bytes] = []
 
-        # Async helper so DataTransposer can await on it.
-        async def append(list: List[bytes], data: bytes):
-            list.append(data)
-
         keep_drop_queue = proxy.KeepDropQueue(
-            lambda data: append(sent_packets, data),
+            sent_packets.append,
             name="test",
             keep_drop_queue=[2, 1, 1, -1],
         )
@@ -269,12 +274,8 @@ class ProxyTest(unittest.IsolatedAsyncioTestCase):
     async def test_keep_drop_queue_transfer_chunks_only(self):
         sent_packets: List[bytes] = []
 
-        # Async helper so DataTransposer can await on it.
-        async def append(list: List[bytes], data: bytes):
-            list.append(data)
-
         keep_drop_queue = proxy.KeepDropQueue(
-            lambda data: append(sent_packets, data),
+            sent_packets.append,
             name="test",
             keep_drop_queue=[2, 1, 1, -1],
             only_consider_transfer_chunks=True,
@@ -327,60 +328,14 @@ class ProxyTest(unittest.IsolatedAsyncioTestCase):
     async def test_window_packet_dropper(self):
         sent_packets: List[bytes] = []
 
-        # Async helper so DataTransposer can await on it.
-        async def append(list: List[bytes], data: bytes):
-            list.append(data)
-
         window_packet_dropper = proxy.WindowPacketDropper(
-            lambda data: append(sent_packets, data),
+            sent_packets.append,
             name="test",
             window_packet_to_drop=0,
         )
 
-        packets = [
-            _encode_rpc_frame(
-                Chunk(
-                    ProtocolVersion.VERSION_TWO,
-                    Chunk.Type.DATA,
-                    data=b'1',
-                    session_id=1,
-                )
-            ),
-            _encode_rpc_frame(
-                Chunk(
-                    ProtocolVersion.VERSION_TWO,
-                    Chunk.Type.DATA,
-                    data=b'2',
-                    session_id=1,
-                )
-            ),
-            _encode_rpc_frame(
-                Chunk(
-                    ProtocolVersion.VERSION_TWO,
-                    Chunk.Type.DATA,
-                    data=b'3',
-                    session_id=1,
-                )
-            ),
-            _encode_rpc_frame(
-                Chunk(
-                    ProtocolVersion.VERSION_TWO,
-                    Chunk.Type.DATA,
-                    data=b'4',
-                    session_id=1,
-                )
-            ),
-            _encode_rpc_frame(
-                Chunk(
-                    ProtocolVersion.VERSION_TWO,
-                    Chunk.Type.DATA,
-                    data=b'5',
-                    session_id=1,
-                )
-            ),
-        ]
-
-        expected_packets = packets[1:]
+        packets = _SESSION_1_DATA_PACKETS
+        expected_packets = list(packets[1:])
 
         # Test each even twice to assure the filter does not have issues
         # on new window bondaries.
@@ -423,68 +378,13 @@ class ProxyTest(unittest.IsolatedAsyncioTestCase):
     async def test_window_packet_dropper_extra_in_flight_packets(self):
         sent_packets: List[bytes] = []
 
-        # Async helper so DataTransposer can await on it.
-        async def append(list: List[bytes], data: bytes):
-            list.append(data)
-
         window_packet_dropper = proxy.WindowPacketDropper(
-            lambda data: append(sent_packets, data),
+            sent_packets.append,
             name="test",
             window_packet_to_drop=1,
         )
 
-        packets = [
-            _encode_rpc_frame(
-                Chunk(
-                    ProtocolVersion.VERSION_TWO,
-                    Chunk.Type.DATA,
-                    data=b'1',
-                    offset=0,
-                )
-            ),
-            _encode_rpc_frame(
-                Chunk(
-                    ProtocolVersion.VERSION_TWO,
-                    Chunk.Type.DATA,
-                    data=b'2',
-                    offset=1,
-                )
-            ),
-            _encode_rpc_frame(
-                Chunk(
-                    ProtocolVersion.VERSION_TWO,
-                    Chunk.Type.DATA,
-                    data=b'3',
-                    offset=2,
-                )
-            ),
-            _encode_rpc_frame(
-                Chunk(
-                    ProtocolVersion.VERSION_TWO,
-                    Chunk.Type.DATA,
-                    data=b'2',
-                    offset=1,
-                )
-            ),
-            _encode_rpc_frame(
-                Chunk(
-                    ProtocolVersion.VERSION_TWO,
-                    Chunk.Type.DATA,
-                    data=b'3',
-                    offset=2,
-                )
-            ),
-            _encode_rpc_frame(
-                Chunk(
-                    ProtocolVersion.VERSION_TWO,
-                    Chunk.Type.DATA,
-                    data=b'4',
-                    offset=3,
-                )
-            ),
-        ]
-
-        expected_packets = packets[1:]
+        packets = _IN_FLIGHT_DATA_PACKETS
 
         # Test each even twice to assure the filter does not have issues
         # on new window bondaries.
@@ -515,71 +415,15 @@ class ProxyTest(unittest.IsolatedAsyncioTestCase):
     async def test_event_filter(self):
         sent_packets: List[bytes] = []
 
-        # Async helper so EventFilter can await on it.
-        async def append(list: List[bytes], data: bytes):
-            list.append(data)
-
         queue = asyncio.Queue()
 
         event_filter = proxy.EventFilter(
-            lambda data: append(sent_packets, data),
+            sent_packets.append,
             name="test",
             event_queue=queue,
         )
 
-        request = packet_pb2.RpcPacket(
-            type=packet_pb2.PacketType.REQUEST,
-            channel_id=101,
-            service_id=1001,
-            method_id=100001,
-        ).SerializeToString()
-
-        packets = [
-            request,
-            _encode_rpc_frame(
-                Chunk(
-                    ProtocolVersion.VERSION_TWO, Chunk.Type.START, session_id=1
-                )
-            ),
-            _encode_rpc_frame(
-                Chunk(
-                    ProtocolVersion.VERSION_TWO,
-                    Chunk.Type.DATA,
-                    session_id=1,
-                    data=b'3',
-                )
-            ),
-            _encode_rpc_frame(
-                Chunk(
-                    ProtocolVersion.VERSION_TWO,
-                    Chunk.Type.DATA,
-                    session_id=1,
-                    data=b'3',
-                )
-            ),
-            request,
-            _encode_rpc_frame(
-                Chunk(
-                    ProtocolVersion.VERSION_TWO, Chunk.Type.START, session_id=2
-                )
-            ),
-            _encode_rpc_frame(
-                Chunk(
-                    ProtocolVersion.VERSION_TWO,
-                    Chunk.Type.DATA,
-                    session_id=2,
-                    data=b'4',
-                )
-            ),
-            _encode_rpc_frame(
-                Chunk(
-                    ProtocolVersion.VERSION_TWO,
-                    Chunk.Type.DATA,
-                    session_id=2,
-                    data=b'5',
-                )
-            ),
-        ]
+        packets = _EVENT_FILTER_PACKETS
 
         expected_events = [
             None,  # request
@@ -602,6 +446,31 @@ class ProxyTest(unittest.IsolatedAsyncioTestCase):
 
 
 def _encode_rpc_frame(chunk: Chunk) -> bytes:
+    # Chunk isn't hashable, so cache on the fields these tests set instead.
+    return _encode_rpc_frame_fields(
+        chunk.protocol_version,
+        chunk.type,
+        chunk.session_id,
+        chunk.offset,
+        chunk.data,
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def _encode_rpc_frame_fields(
+    protocol_version: ProtocolVersion,
+    chunk_type: Chunk.Type,
+    session_id: int,
+    offset: int,
+    data: bytes,
+) -> bytes:
+    chunk = Chunk(
+        protocol_version,
+        chunk_type,
+        session_id=session_id,
+        offset=offset,
+        data=data,
+    )
     packet = packet_pb2.RpcPacket(
         type=packet_pb2.PacketType.SERVER_STREAM,
         channel_id=101,
@@ -612,5 +481,153 @@ def _encode_rpc_frame(chunk: Chunk) -> bytes:
     return encode.ui_frame(73, packet)
 
 
+# Data chunks for session 1 carrying b'1' through b'5'.
+_SESSION_1_DATA_PACKETS = (
+    _encode_rpc_frame(
+        Chunk(
+            ProtocolVersion.VERSION_TWO,
+            Chunk.Type.DATA,
+            data=b'1',
+            session_id=1,
+        )
+    ),
+    _encode_rpc_frame(
+        Chunk(
+            ProtocolVersion.VERSION_TWO,
+            Chunk.Type.DATA,
+            data=b'2',
+            session_id=1,
+        )
+    ),
+    _encode_rpc_frame(
+        Chunk(
+            ProtocolVersion.VERSION_TWO,
+            Chunk.Type.DATA,
+            data=b'3',
+            session_id=1,
+        )
+    ),
+    _encode_rpc_frame(
+        Chunk(
+            ProtocolVersion.VERSION_TWO,
+            Chunk.Type.DATA,
+            data=b'4',
+            session_id=1,
+        )
+    ),
+    _encode_rpc_frame(
+        Chunk(
+            ProtocolVersion.VERSION_TWO,
+            Chunk.Type.DATA,
+            data=b'5',
+            session_id=1,
+        )
+    ),
+)
+
+# Data chunks with a retransmission of offsets 1 and 2 in the middle.
+_IN_FLIGHT_DATA_PACKETS = (
+    _encode_rpc_frame(
+        Chunk(
+            ProtocolVersion.VERSION_TWO,
+            Chunk.Type.DATA,
+            data=b'1',
+            offset=0,
+        )
+    ),
+    _encode_rpc_frame(
+        Chunk(
+            ProtocolVersion.VERSION_TWO,
+            Chunk.Type.DATA,
+            data=b'2',
+            offset=1,
+        )
+    ),
+    _encode_rpc_frame(
+        Chunk(
+            ProtocolVersion.VERSION_TWO,
+            Chunk.Type.DATA,
+            data=b'3',
+            offset=2,
+        )
+    ),
+    _encode_rpc_frame(
+        Chunk(
+            ProtocolVersion.VERSION_TWO,
+            Chunk.Type.DATA,
+            data=b'2',
+            offset=1,
+        )
+    ),
+    _encode_rpc_frame(
+        Chunk(
+            ProtocolVersion.VERSION_TWO,
+            Chunk.Type.DATA,
+            data=b'3',
+            offset=2,
+        )
+    ),
+    _encode_rpc_frame(
+        Chunk(
+            ProtocolVersion.VERSION_TWO,
+            Chunk.Type.DATA,
+            data=b'4',
+            offset=3,
+        )
+    ),
+)
+
+_REQUEST_PACKET = packet_pb2.RpcPacket(
+    type=packet_pb2.PacketType.REQUEST,
+    channel_id=101,
+    service_id=1001,
+    method_id=100001,
+).SerializeToString()
+
+# Two transfers, each preceded by an RPC request packet.
+_EVENT_FILTER_PACKETS = (
+    _REQUEST_PACKET,
+    _encode_rpc_frame(
+        Chunk(ProtocolVersion.VERSION_TWO, Chunk.Type.START, session_id=1)
+    ),
+    _encode_rpc_frame(
+        Chunk(
+            ProtocolVersion.VERSION_TWO,
+            Chunk.Type.DATA,
+            session_id=1,
+            data=b'3',
+        )
+    ),
+    _encode_rpc_frame(
+        Chunk(
+            ProtocolVersion.VERSION_TWO,
+            Chunk.Type.DATA,
+            session_id=1,
+            data=b'3',
+        )
+    ),
+    _REQUEST_PACKET,
+    _encode_rpc_frame(
+        Chunk(ProtocolVersion.VERSION_TWO, Chunk.Type.START, session_id=2)
+    ),
+    _encode_rpc_frame(
+        Chunk(
+            ProtocolVersion.VERSION_TWO,
+            Chunk.Type.DATA,
+            session_id=2,
+            data=b'4',
+        )
+    ),
+    _encode_rpc_frame(
+        Chunk(
+            ProtocolVersion.VERSION_TWO,
+            Chunk.Type.DATA,
+            session_id=2,
+            data=b'5',
+        )
+    ),
+)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -15,6 +15,7 @@
 """Launch a pw_target_runner client that sends a test request."""
 
 import argparse
+import os
 import subprocess
 import sys
 from typing import Optional
@@ -41,6 +42,12 @@ def launch_client(binary: str, server_port: Optional[int]) -> int:
     if server_port is not None:
         cmd.extend(['-port', str(server_port)])
 
+    # Nothing happens after the client exits, so replace this process with it
+    # rather than forking and waiting. Windows has no real exec, so its
+    # emulation can't pass the client's exit code back to our caller.
+    if os.name != 'nt':
+        os.execvp(cmd[0], cmd)
+
     return subprocess.call(cmd)
 
 